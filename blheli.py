@@ -1,8 +1,6 @@
 
 import argparse
 import json
-from blheli_silabs import BlHeliSilabs
-from blheli_atmel import BlHeliAtmel
 
 def parse_key_value_pair(pair):
     """Parses key=value strings into (key, value) tuples."""
@@ -34,11 +32,12 @@ set_config.add_argument("--params", nargs="+", action="append", type=parse_key_v
 # Parse the arguments
 args = parser.parse_args()
 
-# Instanciate interface and connect to ESC
+# Instanciate interface and connect to ESC, only importing the selected one
 if args.interface == 'silabs':
-    interface = BlHeliSilabs(args.port, args.baudrate, args.count, args.verbose)
+    from blheli_silabs import BlHeliSilabs as Interface
 else:
-    interface = BlHeliAtmel(args.port, args.baudrate, args.count, args.verbose)
+    from blheli_atmel import BlHeliAtmel as Interface
+interface = Interface(args.port, args.baudrate, args.count, args.verbose)
 
 try:
 
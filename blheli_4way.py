@@ -2,7 +2,7 @@ import serial
 import time
 
 from blheli_log import log
-from blheli_protocol import BLHeliProtocol as protocol
+from blheli_protocol import BLHeliProtocol as protocol, BLHeliDecodingError
 
 class BLHeli4WayInterface:
     """
@@ -13,6 +13,9 @@ class BLHeli4WayInterface:
      * 4-way Arduino interface
     """
 
+    # Delay for an ESC to restart after reset, in seconds
+    RESET_DELAY = 1.0
+
     def __init__(self, port, baudrate=115200, count=4, verbose=False):
         self.verbose = verbose
         self.count = count
@@ -25,6 +28,11 @@ class BLHeli4WayInterface:
         try:
             self.serial_connection = serial.Serial(self.port, self.baudrate, timeout=1)
             log(f"Connected to {self.port} at {self.baudrate} baud.")
+            # Reduce USB-serial adapters latency, when supported by driver
+            try:
+                self.serial_connection.set_low_latency_mode(True)
+            except (ValueError, NotImplementedError, AttributeError, OSError):
+                pass
             time.sleep(0.5)
             self.flush_input()
         except serial.SerialException:
@@ -38,35 +46,45 @@ class BLHeli4WayInterface:
     
     def flush_input(self):
         """Discard all pending serial data"""
-        self.serial_connection.flush()
+        self.serial_connection.reset_input_buffer()
 
-    def send_command(self, command, address=0, payload=[0]):
+    def send_command(self, command, address=0, payload=b'\x00'):
         """Send a command to the ESC."""
         frame = protocol.build(command, address, payload)
         self.serial_connection.write(frame)
         if self.verbose:
             log("->", frame.hex())
-        time.sleep(0.1)  # Short delay for ESC to process
 
-    def read_response(self, expected_length=64):
+    def read_response(self):
         """Read and decode response from the ESC."""
-        response = self.serial_connection.read(expected_length)
+        # Block until start byte is received, discarding stray data
+        response = self.serial_connection.read_until(bytes([protocol.RESPONSE_START_BYTE]))
+        if response[-1:] == bytes([protocol.RESPONSE_START_BYTE]):
+            if self.verbose and len(response) > 1:
+                log("<- (discarded)", response[:-1].hex())
+            # Read header, then payload, command status and crc16 as soon as payload length is known (null length stands for 256)
+            response = response[-1:] + self.serial_connection.read(protocol.HEADER_SIZE - 1)
+            if len(response) == protocol.HEADER_SIZE:
+                response += self.serial_connection.read((response[-1] or 256) + protocol.RESPONSE_TRAILER_SIZE)
         if self.verbose:
             log("<-", response.hex())
         return protocol.parse(response)
     
     def init_flash(self, esc):
         """Init device flash and return interface type ("silabs" or "atmel")"""
-        self.send_command('device_init_flash', payload=[esc])
-        payload = protocol.parse_payload(self.read_response())
-        if payload.mode in ('SiLabsC2', 'SiLabsBLB'):
+        self.send_command('device_init_flash', payload=bytes([esc]))
+        payload = self.read_response().payload
+        if len(payload) < 4:
+            raise BLHeliDecodingError(f"Invalid init flash payload ({payload.hex()})")
+        # Check raw mode byte : SiLabsC2 (0), SiLabsBLB (1), AtmelBLB (2) or AtmelSK (3)
+        if payload[3] in (0, 1):
             return 'silabs'
         else:
             return 'atmel'
         
     def erase_page(self, page):
         """!!! Erase one page in device memory"""
-        self.send_command('device_page_erase', payload=[page])
+        self.send_command('device_page_erase', payload=bytes([page]))
         self.read_response()
 
     def write_memory(self, address, data):
@@ -76,19 +94,27 @@ class BLHeli4WayInterface:
 
     def read_memory(self, address, length):
         """Read data from device memory."""
-        self.send_command('device_read', address, [length])
-        return bytes(self.read_response(length + 8).payload)
+        self.send_command('device_read', address, bytes([length]))
+        return self.read_response().payload
 
     def reset_esc(self, esc):
         """Reset the ESC."""
-        self.send_command(command='device_reset', payload=[esc])
+        self._await_reset(self._send_reset(esc))
+
+    def _send_reset(self, esc):
+        """Reset the ESC without waiting for it to restart. Return the time at which it will be ready"""
+        self.send_command(command='device_reset', payload=bytes([esc]))
         self.read_response()
-        time.sleep(1.0)
+        return time.monotonic() + self.RESET_DELAY
+
+    def _await_reset(self, deadline):
+        """Wait for a reset ESC to restart"""
+        time.sleep(max(0, deadline - time.monotonic()))
 
     def get_name(self):
         """Read and return interface name"""
         self.send_command(command='interface_get_name')
-        return bytes(self.read_response()['payload'][1:]).decode('utf-8')
+        return self.read_response().payload[1:].decode('utf-8')
     
     def test_alive(self):
         """Identify ESC (generate a startup tone) and assert that communication is working"""
@@ -14,7 +14,6 @@ class BlHeliAtmel(BLHeli4WayInterface):
         """Connect serial port and test communication"""
         # Open serial port
         super().connect()
-        self.flush_input()
         # Test connection
         self.test_alive()
         # Interface name
@@ -1,5 +1,7 @@
-import crcmod
-from construct import Byte, Struct, Int8ul, Int16ub, Enum, Const, PrefixedArray, Default
+import binascii
+import struct
+from collections import namedtuple
+from construct import Byte, Struct, Int8ul, Enum, GreedyBytes
 
 class BLHeliEncodingError(Exception):
     """Exception raised for BLHeli encoding errors.
@@ -21,6 +23,13 @@ class BLHeliDecodingError(Exception):
         self.message = message
         super().__init__('Decoding error: ' + self.message)
 
+def _compile_by_opcode(payload_structs, opcodes):
+    """Compile payload structures and key them by command opcode"""
+    return {opcodes[command]: subcon.compile() for command, subcon in payload_structs.items()}
+
+# Decoded frame
+BLHeliFrame = namedtuple('BLHeliFrame', ['start_byte', 'command', 'address', 'payload', 'ack', 'crc'])
+
 class BLHeliProtocol:
     """
     Helper class to build and parse BLHeli protocol frames
@@ -56,34 +65,29 @@ class BLHeliProtocol:
                           invalid_param=0x09,
                           general_error=0x0f)
 
-    # Define the command request structure using construct
-    REQUEST = Struct(
-        "start_byte" / Const(REQUEST_START_BYTE, Byte),     # Start byte, 0x2F for sending
-        "command" / COMMAND_ENUM,                           # Command byte
-        "address" / Default(Int16ub, 0),                    # 16-bit address
-        "payload" / PrefixedArray(Int8ul, Byte),            # Payload depending on command
-        "crc" / Int16ub,                                    # CRC16
-    )
-
-    # Define the command response structure using construct
-    RESPONSE = Struct(
-        "start_byte" / Const(RESPONSE_START_BYTE, Byte),    # Start byte, 0x2E for receiving
-        "command" / COMMAND_ENUM,                           # Command byte
-        "address" / Default(Int16ub, 0),                    # 16-bit address
-        "payload" / PrefixedArray(Int8ul, Byte),            # Payload depending on command
-        "ack" / ACK_ENUM,                                   # Command status
-        "crc" / Int16ub,                                    # CRC16
-    )
+    # Opcode and status lookup tables, mirroring COMMAND_ENUM and ACK_ENUM mappings
+    _CMD_NAME_TO_INT = dict(COMMAND_ENUM.encmapping)
+    _CMD_INT_TO_NAME = dict(COMMAND_ENUM.decmapping)
+    _ACK_INT_TO_NAME = dict(ACK_ENUM.decmapping)
+
+    # Frame header : start byte, command byte, 16-bit address, payload length
+    # It is followed by the payload, the command status (responses only) and the CRC16
+    _HDR = struct.Struct('>BBHB')
+    _CRC = struct.Struct('>H')
+
+    # Frame header size, and response trailer size (command status and CRC16)
+    HEADER_SIZE = _HDR.size
+    RESPONSE_TRAILER_SIZE = 3
 
     # Define payloads
     REQUEST_PAYLOAD = {
         'device_reset': Struct("esc_channel" / Int8ul),
         'device_page_erase': Struct("page_number"/ Int8ul),
         'device_read': Struct("length" / Int8ul),
-        'device_write': PrefixedArray(Int8ul, Byte),
+        'device_write': GreedyBytes,
         'device_c2ck_low': Struct("esc_channel" / Int8ul),
         'device_read_eeprom': Struct("length" / Int8ul),
-        'device_write_eeprom': PrefixedArray(Int8ul, Byte),
+        'device_write_eeprom': GreedyBytes,
         'interface_set_mode': Struct("esc_channel" / Int8ul)
     }
 
@@ -91,19 +95,31 @@ class BLHeliProtocol:
         'device_init_flash': Struct("HiSign" / Byte, "LoSign" / Byte, "BootMsg" / Byte, "mode" / Enum(Byte, SiLabsC2=0, SiLabsBLB=1, AtmelBLB=2, AtmelSK=3))
     }
 
-    # Create XMODEM CRC16 function
-    CRC16_XMODEM = crcmod.mkCrcFun(0x11021, rev=False, initCrc=0x0000, xorOut=0x0000)
+    # Compiled payloads structures, keyed by command opcode
+    _REQ_PAYLOAD_BY_OP = _compile_by_opcode(REQUEST_PAYLOAD, _CMD_NAME_TO_INT)
+    _RESP_PAYLOAD_BY_OP = _compile_by_opcode(RESPONSE_PAYLOAD, _CMD_NAME_TO_INT)
+
+    # XMODEM CRC16 function (polynomial 0x1021, init 0), implemented in C by binascii
+    CRC16_XMODEM = staticmethod(lambda buf: binascii.crc_hqx(buf, 0))
 
     @staticmethod
-    def build(command, address=0, payload=[0]):
+    def build(command, address=0, payload=b'\x00'):
         """Build and encode a command frame"""
         try:
-            # Encode the frame a first time with dummy CRC16
-            frame = BLHeliProtocol.REQUEST.build(dict(command=command, address=address, payload=payload, crc=0))
-            # Compute CRC16
-            crc = BLHeliProtocol.CRC16_XMODEM(frame[:-2])
-            # Reencode frame with right CRC16
-            frame = BLHeliProtocol.REQUEST.build(dict(command=command, address=address, payload=payload, crc=crc))
+            # Check parameter, a 256 bytes payload is encoded with a null length
+            if not 0 < len(payload) <= 256:
+                raise BLHeliEncodingError(f"Invalid payload length ({len(payload)})")
+            # Encode header and payload in place, in a single frame buffer
+            opcode = BLHeliProtocol._CMD_NAME_TO_INT[command]
+            frame = bytearray(BLHeliProtocol.HEADER_SIZE + len(payload) + BLHeliProtocol._CRC.size)
+            BLHeliProtocol._HDR.pack_into(frame, 0, BLHeliProtocol.REQUEST_START_BYTE, opcode, address, len(payload) & 0xFF)
+            frame[BLHeliProtocol.HEADER_SIZE:-BLHeliProtocol._CRC.size] = payload
+            # Compute CRC16 and append it
+            BLHeliProtocol._CRC.pack_into(frame, len(frame) - BLHeliProtocol._CRC.size, BLHeliProtocol.CRC16_XMODEM(memoryview(frame)[:-BLHeliProtocol._CRC.size]))
+        except KeyError:
+            raise BLHeliEncodingError(f"Unknown command ({command})")
+        except BLHeliEncodingError:
+            raise
         except Exception as e:
             raise BLHeliEncodingError(str(e))
         return frame
@@ -114,30 +130,38 @@ class BLHeliProtocol:
         # Check parameter
         if not len(frame):
             raise BLHeliDecodingError(f"Null length frame")
-        # Parse frame
-        try:
-            parsed = BLHeliProtocol.RESPONSE.parse(frame)
-        except Exception as e:
-            raise BLHeliDecodingError(str(e))
+        if len(frame) < BLHeliProtocol.HEADER_SIZE + BLHeliProtocol.RESPONSE_TRAILER_SIZE:
+            raise BLHeliDecodingError(f"Truncated frame ({frame.hex()})")
         # Check start byte
-        if parsed.start_byte != BLHeliProtocol.RESPONSE_START_BYTE:
-            raise BLHeliDecodingError(f"Invalid start byte ({parsed.start_byte})")
-        # Check crc16
-        if parsed.crc != BLHeliProtocol.CRC16_XMODEM(frame[:-2]):
+        if frame[0] != BLHeliProtocol.RESPONSE_START_BYTE:
+            raise BLHeliDecodingError(f"Invalid start byte ({frame[0]})")
+        # Check crc16 on raw frame, before decoding anything else
+        crc = int.from_bytes(frame[-2:], 'big')
+        if crc != BLHeliProtocol.CRC16_XMODEM(frame[:-2]):
             raise BLHeliDecodingError(f"Invalid crc ({frame[-2:].hex()})")
-        return parsed
+        # Parse header and check frame length
+        start_byte, command, address, length = BLHeliProtocol._HDR.unpack_from(frame, 0)
+        if len(frame) != BLHeliProtocol.HEADER_SIZE + (length or 256) + BLHeliProtocol.RESPONSE_TRAILER_SIZE:
+            raise BLHeliDecodingError(f"Invalid frame length ({len(frame)})")
+        # Unknown command and status codes are kept as integers
+        return BLHeliFrame(start_byte=start_byte,
+                           command=BLHeliProtocol._CMD_INT_TO_NAME.get(command, command),
+                           address=address,
+                           payload=bytes(frame[BLHeliProtocol.HEADER_SIZE:-BLHeliProtocol.RESPONSE_TRAILER_SIZE]),
+                           ack=BLHeliProtocol._ACK_INT_TO_NAME.get(frame[-3], frame[-3]),
+                           crc=crc)
 
     @staticmethod
     def parse_payload(frame):
         """Parse payload, based on command identifier"""
-        # Extract raw payload in bytes
-        raw_payload = bytes(frame.payload)
+        raw_payload = frame.payload
         # Check if the frame is a request or a response, to retreive payload structure
-        payload_structs = BLHeliProtocol.REQUEST_PAYLOAD if frame.start_byte == BLHeliProtocol.REQUEST_START_BYTE else BLHeliProtocol.RESPONSE_PAYLOAD
+        payload_structs = BLHeliProtocol._REQ_PAYLOAD_BY_OP if frame.start_byte == BLHeliProtocol.REQUEST_START_BYTE else BLHeliProtocol._RESP_PAYLOAD_BY_OP
         # If payload struct is known, parse it. Otherwise return raw payload
-        if frame.command in payload_structs:
+        payload_struct = payload_structs.get(int(frame.command))
+        if payload_struct is not None:
             try:
-                return payload_structs[frame.command].parse(raw_payload)
+                return payload_struct.parse(raw_payload)
             except Exception as e:
                 raise BLHeliDecodingError('Failed to parse payload ' + str(e))
         else:
@@ -157,6 +181,14 @@ if __name__ == '__main__':
     except BLHeliDecodingError:
         pass
 
+    print('Test - Parse - start byte verification')
+    try:
+        BLHeliProtocol.parse(bytes.fromhex("2F3400000100004263"))
+        # We must raise an exception because start byte is a request one
+        assert(False)
+    except BLHeliDecodingError:
+        pass
+
     print('Test - Parse - payload')
     parsed = BLHeliProtocol.parse(bytes.fromhex("2E37000004F330AA0100F7F0"))
     assert(str(BLHeliProtocol.parse_payload(parsed).mode) == 'SiLabsBLB')
@@ -165,6 +197,19 @@ if __name__ == '__main__':
     built = BLHeliProtocol.build('device_erase_all')
     assert(built.hex() == "2f3800000100cdf9")
 
+    print('Test - Build - max payload length')
+    built = BLHeliProtocol.build('device_write', address=0x1a00, payload=bytes(256))
+    assert(built[4] == 0 and len(built) == 263)
+
+    print('Test - Build - invalid payload')
+    for payload in (b'', bytes(257), 15):
+        try:
+            BLHeliProtocol.build('device_read', payload=payload)
+            # We must raise an exception because payload is invalid
+            assert(False)
+        except BLHeliEncodingError:
+            pass
+
     print('Test - Build - params')
-    built = BLHeliProtocol.build('device_read', address=0xaabb, payload=[15])
+    built = BLHeliProtocol.build('device_read', address=0xaabb, payload=bytes([15]))
     assert(built.hex() == "2f3aaabb010ff446")
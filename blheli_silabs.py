@@ -1,7 +1,49 @@
+import time
+from operator import itemgetter
 from blheli_4way import BLHeli4WayInterface
 from construct import Byte, Struct, Int16ub, Enum, Padding, Flag, PaddedString
 from blheli_log import log
 
+# Accepted flag values, as given on command-line
+_FLAG_STRINGS = {'1': True, 'true': True, 'yes': True, 'on': True, '0': False, 'false': False, 'no': False, 'off': False}
+
+def _encode_byte(value):
+    """Encode a Byte field, from integer or command-line decimal string"""
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        value = int(value)
+    if type(value) is not int or not 0 <= value <= 0xFF:
+        raise ValueError(f'Invalid byte value {value}')
+    return bytes([value])
+
+def _encode_flag(value):
+    """Encode a Flag field, from boolean, number or command-line string"""
+    if isinstance(value, str):
+        value = _FLAG_STRINGS[value.lower()]
+    return b'\x01' if value else b'\x00'
+
+def _enum_encoder(encmapping, decmapping):
+    """Return the encoder of a one byte Enum field, from value name or known raw integer value"""
+    def encode(value):
+        if isinstance(value, str):
+            return bytes([encmapping[value]])
+        if type(value) is int and value in decmapping:
+            return bytes([value])
+        raise ValueError(f'Invalid enum value {value}')
+    return encode
+
+def _field_encoders(layout, fields):
+    """Return raw encoders of one byte layout fields, so that config writes do not involve construct"""
+    encoders = {}
+    for subcon in layout.subcons:
+        if subcon.name in fields:
+            if isinstance(subcon.subcon, Enum):
+                encoders[subcon.name] = _enum_encoder(dict(subcon.subcon.encmapping), dict(subcon.subcon.decmapping))
+            elif subcon.subcon is Flag:
+                encoders[subcon.name] = _encode_flag
+            else:
+                encoders[subcon.name] = _encode_byte
+    return encoders
+
 class BlHeliSilabs(BLHeli4WayInterface):
     """
     Manipulate a BLHeli Silabs ESC configuration over a 4-way interface
@@ -44,7 +86,10 @@ class BlHeliSilabs(BLHeli4WayInterface):
         "layout" /                     PaddedString(16, "utf8"),                                                                                    # offset: 0x40, size: 16
         "mcu" /                        PaddedString(16, "utf8"),                                                                                    # offset: 0x50, size: 16
         "name" /                       PaddedString(16, "utf8"),                                                                                    # offset: 0x60, size: 16
-    )
+    ).compile()
+
+    # EEPROM_LAYOUT total size
+    _EEPROM_SIZE = 0x70
 
     DEVICE_INFO_FIELDS = ['main_revision', 'sub_revision', 'mode', 'layout', 'mcu', 'name']
 
@@ -53,6 +98,23 @@ class BlHeliSilabs(BLHeli4WayInterface):
 
     ESC_CONFIG_FIELDS = ['motor_direction', 'ppm_min_throttle', 'ppm_max_throttle', 'ppm_center_throttle']
 
+    # Config fields offsets in EEPROM, all config fields are one byte long
+    _FIELD_OFFSETS = {'startup_power': 0x09, 'motor_direction': 0x0B, 'programming_by_tx': 0x0F, 'commutation_timing': 0x15,
+                      'ppm_min_throttle': 0x19, 'ppm_max_throttle': 0x1A, 'beep_strength': 0x1B, 'beacon_strength': 0x1C,
+                      'beacon_delay': 0x1D, 'demag_compensation': 0x1F, 'ppm_center_throttle': 0x21, 'temperature_protection': 0x23,
+                      'low_rpm_power_protection': 0x24, 'brake_on_stop': 0x27, 'led_control': 0x28}
+
+    # Config fields encoders
+    _ENCODERS = _field_encoders(EEPROM_LAYOUT.defersubcon, _FIELD_OFFSETS)
+
+    # Fields getters, to extract all fields of a list at once
+    _DEVICE_INFO_GETTER = itemgetter(*DEVICE_INFO_FIELDS)
+    _COMMON_CONFIG_GETTER = itemgetter(*COMMON_CONFIG_FIELDS)
+    _ESC_CONFIG_GETTER = itemgetter(*ESC_CONFIG_FIELDS)
+
+    # Raw EEPROM bytes getter, to compare common config of ESCs at once
+    _COMMON_CONFIG_BYTES_GETTER = itemgetter(*map(_FIELD_OFFSETS.__getitem__, COMMON_CONFIG_FIELDS))
+
     def __init__(self, port, baudrate=115200, count=4, verbose=False):
         super().__init__(port, baudrate, count, verbose)
 
@@ -60,7 +122,6 @@ class BlHeliSilabs(BLHeli4WayInterface):
         """Connect serial port and test communication"""
         # Open serial port
         super().connect()
-        self.flush_input()
         # Test connection
         self.test_alive()
         # Interface name
@@ -83,56 +144,132 @@ class BlHeliSilabs(BLHeli4WayInterface):
         # Check parameter
         assert(esc >= 0 and esc < self.count)
         # Read EEPROM content from memory
-        self.init_flash(esc)
-        eeprom = self.EEPROM_LAYOUT.parse(self.read_memory(BlHeliSilabs.CONFIG_ADDRESS, self.EEPROM_LAYOUT.sizeof()))
+        eeprom = self.EEPROM_LAYOUT.parse(self._read_eeprom(esc))
         # Reset ESC to deinit flash and load config
         self.reset_esc(esc)
-        # Extract device info, common and specific config from layout
-        device_info = {field: str(eeprom[field]).strip() for field in self.DEVICE_INFO_FIELDS}
-        common_config = {field: eeprom[field] for field in self.COMMON_CONFIG_FIELDS}
-        esc_config = {field: eeprom[field] for field in self.ESC_CONFIG_FIELDS}
+        return self._split_config(eeprom)
+
+    def _read_eeprom(self, esc):
+        """Init device flash and read raw EEPROM content from memory. ESC must be reset afterwards"""
+        self.init_flash(esc)
+        return self.read_memory(BlHeliSilabs.CONFIG_ADDRESS, self._EEPROM_SIZE)
+
+    def _split_config(self, eeprom):
+        """Extract device info, common and specific config from EEPROM layout"""
+        device_info = {field: str(value).strip() for field, value in zip(self.DEVICE_INFO_FIELDS, self._DEVICE_INFO_GETTER(eeprom))}
+        common_config = dict(zip(self.COMMON_CONFIG_FIELDS, self._COMMON_CONFIG_GETTER(eeprom)))
+        esc_config = dict(zip(self.ESC_CONFIG_FIELDS, self._ESC_CONFIG_GETTER(eeprom)))
         return (device_info, common_config, esc_config)
 
     def read_config_all(self):
         """Read config from device memory. Return a tuple containing (device_info, configs)"""
         escs = []
+        deadline = time.monotonic()
         for esc in range(self.count):
-            esc_info, esc_common_config, esc_config = self.read_config(esc)
+            eeprom = self._read_eeprom(esc)
+            # Reset ESC to deinit flash, and go on with next ESC while it restarts
+            deadline = self._send_reset(esc)
+            esc_info, esc_common_config, esc_config = self._split_config(self.EEPROM_LAYOUT.parse(eeprom))
             escs.append(dict(info=esc_info, config=esc_config))
+            # Compare common config raw bytes with first ESC ones
             if esc == 0:
                 common_config = esc_common_config
+                common_bytes = self._COMMON_CONFIG_BYTES_GETTER(eeprom)
             else:
-                if common_config != esc_common_config:
+                if common_bytes != self._COMMON_CONFIG_BYTES_GETTER(eeprom):
                     log(f"Warning : Common config mismatch for ESC #{esc + 1}")
+        # Wait for last ESC to restart, previous ones are already up
+        self._await_reset(deadline)
         return (common_config, escs)
 
     def write_config(self, esc, **params):
         """Read parameters into device config memory"""
         # Check parameter
         assert(esc >= 0 and esc < self.count)
-        # Read EEPROM content from memory
-        self.init_flash(esc)
-        eeprom = self.EEPROM_LAYOUT.parse(self.read_memory(BlHeliSilabs.CONFIG_ADDRESS, self.EEPROM_LAYOUT.sizeof()))
-        # Patch EEPROM contents with updated parameters
-        for key, value in params.items():
-            if key in BlHeliSilabs.COMMON_CONFIG_FIELDS or key in BlHeliSilabs.ESC_CONFIG_FIELDS:
-                eeprom[key] = value
-            else:
-                log('Invalid parameter', key)
+        # Read EEPROM content from memory, and patch it with updated parameters
+        eeprom = bytearray(self._read_eeprom(esc))
+        self._patch_eeprom(eeprom, self._encode_params(params))
         # Write back config in memory
-        self.erase_page(int(BlHeliSilabs.CONFIG_ADDRESS / BlHeliSilabs.PAGE_SIZE))
-        self.write_memory(BlHeliSilabs.CONFIG_ADDRESS, self.EEPROM_LAYOUT.build(eeprom))
+        self._write_eeprom(bytes(eeprom))
         # Reset ESC to deinit flash and load config
         self.reset_esc(esc)
 
     def write_config_all(self, **params):
         """Read parameters into device config memory"""
+        patches = self._encode_params(params)
+        deadline = time.monotonic()
         for esc in range(self.count):
             log(f'ESC #{esc + 1}')
-            self.write_config(esc, **params)
+            # Read EEPROM content from memory, and patch it with updated parameters
+            eeprom = bytearray(self._read_eeprom(esc))
+            self._patch_eeprom(eeprom, patches)
+            # Write back config in memory
+            self._write_eeprom(bytes(eeprom))
+            # Reset ESC to deinit flash and load config, and go on with next ESC while it restarts
+            deadline = self._send_reset(esc)
+        # Wait for last ESC to restart, previous ones are already up
+        self._await_reset(deadline)
+
+    def _encode_params(self, params):
+        """Encode updated parameters. Return a list of (offset, raw bytes) EEPROM patches"""
+        patches = []
+        for key, value in params.items():
+            if key in self._FIELD_OFFSETS:
+                try:
+                    patches.append((self._FIELD_OFFSETS[key], self._ENCODERS[key](value)))
+                except (KeyError, ValueError, TypeError):
+                    raise Exception(f'Invalid value {value} for parameter {key}')
+            else:
+                log('Invalid parameter', key)
+        return patches
+
+    @staticmethod
+    def _patch_eeprom(eeprom, patches):
+        """Patch raw EEPROM contents in place"""
+        for offset, data in patches:
+            eeprom[offset:offset + len(data)] = data
+
+    def _write_eeprom(self, data):
+        """Write EEPROM contents in memory. ESC must be reset afterwards"""
+        self.erase_page(int(BlHeliSilabs.CONFIG_ADDRESS / BlHeliSilabs.PAGE_SIZE))
+        self.write_memory(BlHeliSilabs.CONFIG_ADDRESS, data)
 
 if __name__ == '__main__':
 
+    print('Test - Encode - enum name')
+    assert(BlHeliSilabs._ENCODERS['startup_power']('1.00') == b'\x0b')
+    assert(BlHeliSilabs._ENCODERS['motor_direction'](3) == b'\x03')
+
+    print('Test - Encode - invalid enum values')
+    for field, value in (('startup_power', '1'), ('temperature_protection', '80'), ('motor_direction', 9), ('motor_direction', True)):
+        try:
+            BlHeliSilabs._ENCODERS[field](value)
+            # We must raise an exception because value is not a known enum value
+            assert(False)
+        except (KeyError, ValueError):
+            pass
+
+    print('Test - Encode - flag strings')
+    assert(BlHeliSilabs._ENCODERS['brake_on_stop']('True') == b'\x01')
+    assert(BlHeliSilabs._ENCODERS['brake_on_stop']('off') == b'\x00')
+
+    print('Test - Encode - byte values')
+    assert(BlHeliSilabs._ENCODERS['ppm_min_throttle']('40') == b'\x28')
+    for value in ('256', 256, -1, 1.5, '1.5', True):
+        try:
+            BlHeliSilabs._ENCODERS['ppm_min_throttle'](value)
+            # We must raise an exception because value is not a valid byte
+            assert(False)
+        except ValueError:
+            pass
+
+    print('Test - Encode - invalid parameter value')
+    try:
+        BlHeliSilabs('', count=1)._encode_params({'beep_strength': None})
+        assert(False)
+    except Exception as e:
+        assert(str(e) == 'Invalid value None for parameter beep_strength')
+
     import argparse
 
     parser = argparse.ArgumentParser(description="Silabs BLHeli testing")